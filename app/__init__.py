@@ -1,5 +1,6 @@
 # app/__init__.py
 from flask import Flask
+from werkzeug.middleware.proxy_fix import ProxyFix
 import os
 
 def create_app():
@@ -8,17 +9,36 @@ def create_app():
                 static_folder='../static',
                 template_folder='../static')
 
+    # Trust one reverse proxy for X-Forwarded-For so request.remote_addr is the client IP
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1)
+
     # Load configuration
     app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'dev-secret-key-change-in-production')
     app.config['IP_REPUTATION_API_KEY'] = os.environ.get('IP_REPUTATION_API_KEY', '')
+    app.config['REDIS_URL'] = os.environ.get('REDIS_URL', 'redis://localhost:6379/0')
 
     # Rate limiting configuration
     app.config['MAX_LOGIN_ATTEMPTS'] = 5
     app.config['RATE_LIMIT_WINDOW'] = 300  # 5 minutes in seconds
 
+    # Pre-check limits applied before bot scoring
+    app.config['PRECHECK_IP_LIMIT'] = 5
+    app.config['PRECHECK_IP_WINDOW'] = 60  # 1 minute in seconds
+    app.config['PRECHECK_USER_LIMIT'] = 10
+    app.config['PRECHECK_USER_WINDOW'] = 3600  # 1 hour in seconds
+
+    # Record retention
+    app.config['RECORD_RETENTION_DAYS'] = 7
+    app.config['CLEANUP_INTERVAL'] = 3600  # 1 hour in seconds
+
     # Bot scoring thresholds
     app.config['BOT_SCORE_THRESHOLD'] = 100  # Block if score >= 100 (lowered for testing)
 
+    # Cache hot-path settings on the anti-bot module
+    from app import anti_bot_logic
+    for key in anti_bot_logic.CONFIG_KEYS:
+        setattr(anti_bot_logic, key, app.config[key])
+
     # Register routes
     from app.routes import bp
     app.register_blueprint(bp)
@@ -27,4 +47,17 @@ def create_app():
     from app.database import init_db
     init_db()
 
+    # Periodically prune old records so the tables stay small
+    from app.database import start_cleanup
+    start_cleanup(app)
+
+    # Start background writer for login attempt audit records
+    from app import audit_writer
+    audit_writer.start()
+
+    # Start batch lookups for IP reputation cache misses
+    if app.config['IP_REPUTATION_API_KEY']:
+        from app import ip_reputation_cache
+        ip_reputation_cache.start(app.config['IP_REPUTATION_API_KEY'])
+
     return app
@@ -4,17 +4,123 @@ SentinelAuth Anti-Bot Logic
 Contains all bot detection and scoring functions for the five defensive layers.
 """
 
-import json
-import requests
-from flask import current_app, request
-from typing import Dict, Tuple
+import re
+import time
+import orjson
+import redis
+from uuid import uuid4
+from flask import current_app
+from dataclasses import dataclass, field
+from typing import Dict, List, Mapping, Tuple
+
+from app import ip_reputation_cache
+
+
+# ========================================
+# SETTINGS
+# ========================================
+# Copied from app.config by create_app so the hot path avoids current_app lookups
+
+MAX_LOGIN_ATTEMPTS = 5
+RATE_LIMIT_WINDOW = 300
+PRECHECK_IP_LIMIT = 5
+PRECHECK_IP_WINDOW = 60
+PRECHECK_USER_LIMIT = 10
+PRECHECK_USER_WINDOW = 3600
+BOT_SCORE_THRESHOLD = 100
+IP_REPUTATION_API_KEY = ''
+
+CONFIG_KEYS = (
+    'MAX_LOGIN_ATTEMPTS',
+    'RATE_LIMIT_WINDOW',
+    'PRECHECK_IP_LIMIT',
+    'PRECHECK_IP_WINDOW',
+    'PRECHECK_USER_LIMIT',
+    'PRECHECK_USER_WINDOW',
+    'BOT_SCORE_THRESHOLD',
+    'IP_REPUTATION_API_KEY'
+)
+
+# Client input size limits, checked before any parsing
+MAX_METADATA_LENGTH = 4096
+MAX_FINGERPRINT_LENGTH = 256
+FINGERPRINT_RE = re.compile(r'[0-9a-z]+')
+
+
+# ========================================
+# LAYER RESULT
+# ========================================
+
+@dataclass(slots=True)
+class LayerResult:
+    """Outcome of a single detection layer."""
+
+    layer: str
+    score: int = 0
+    flags: List[str] = field(default_factory=list)
+    extras: Dict = field(default_factory=dict)
+
+    def to_dict(self) -> Dict:
+        """Serialize to the details dict returned in the analysis."""
+        return {'layer': self.layer, 'flags': self.flags, **self.extras}
+
+
+# ========================================
+# PRE-CHECK: FIXED-WINDOW COUNTERS
+# ========================================
+
+def precheck(ip_address: str, username: str) -> Tuple[bool, int]:
+    """
+    Cheap per-IP and per-username gate run before full bot scoring.
+
+    Each counter is a Redis INCR whose window starts at the first hit, so an
+    abusive client is rejected after a single round-trip without parsing
+    metadata or touching SQLite.
+
+    Args:
+        ip_address: Client IP address
+        username: Attempted username
+
+    Returns:
+        Tuple of (is_blocked, retry_after_seconds)
+    """
+    from app.database import get_redis
+
+    ip_key = f"rl:ip:{ip_address}"
+    user_key = f"rl:user:{username}"
+    try:
+        pipe = get_redis().pipeline()
+        pipe.incr(ip_key)
+        pipe.expire(ip_key, PRECHECK_IP_WINDOW, nx=True)
+        pipe.incr(user_key)
+        pipe.expire(user_key, PRECHECK_USER_WINDOW, nx=True)
+        pipe.ttl(ip_key)
+        pipe.ttl(user_key)
+        ip_count, _, user_count, _, ip_ttl, user_ttl = pipe.execute()
+    except redis.RedisError as e:
+        # Fail open - check_rate_limit still enforces limits via SQLite
+        current_app.logger.warning('Pre-check skipped, Redis unavailable: %s', e)
+        return False, 0
+
+    ip_blocked = ip_count > PRECHECK_IP_LIMIT
+    user_blocked = user_count > PRECHECK_USER_LIMIT
+    is_blocked = ip_blocked or user_blocked
+
+    # TTL is 0 in a key's last second and -1 without an expiry; always ask for at least 1s
+    retry_after = 0
+    if ip_blocked:
+        retry_after = max(retry_after, ip_ttl, 1)
+    if user_blocked:
+        retry_after = max(retry_after, user_ttl, 1)
+
+    return is_blocked, retry_after
 
 
 # ========================================
 # LAYER 1: BEHAVIORAL TIMING ANALYSIS
 # ========================================
 
-def analyze_timing_behavior(timing_score: int, metadata: str) -> Tuple[int, Dict]:
+def analyze_timing_behavior(timing_score: int, metadata: str) -> LayerResult:
     """
     Analyze user timing behavior to detect automation.
 
@@ -23,50 +129,53 @@ def analyze_timing_behavior(timing_score: int, metadata: str) -> Tuple[int, Dict
         metadata: JSON string with detailed timing information
 
     Returns:
-        Tuple of (score, details_dict)
+        LayerResult for the timing layer
     """
-    score = timing_score
-    details = {'layer': 'timing', 'flags': []}
+    result = LayerResult('timing', timing_score)
 
     try:
-        timing_data = json.loads(metadata)
+        # Oversized (or missing) metadata is rejected without parsing
+        if len(metadata) > MAX_METADATA_LENGTH:
+            raise TypeError(f'metadata exceeds {MAX_METADATA_LENGTH} characters')
+
+        timing_data = orjson.loads(metadata)
 
         # Flag 1: Suspiciously fast total interaction
         if timing_data.get('t_load_to_submit', 0) < 800:
-            details['flags'].append('fast_submission')
-            details['submission_time_ms'] = timing_data.get('t_load_to_submit', 0)
+            result.flags.append('fast_submission')
+            result.extras['submission_time_ms'] = timing_data.get('t_load_to_submit', 0)
 
         # Flag 2: No focus event recorded
         if timing_data.get('t_first_focus') is None or timing_data.get('t_first_focus', 0) == 0:
-            score += 20
-            details['flags'].append('no_focus_event')
+            result.score += 20
+            result.flags.append('no_focus_event')
 
         # Flag 3: No typing detected
         if timing_data.get('t_first_key') is None:
-            score += 15
-            details['flags'].append('no_typing_detected')
+            result.score += 15
+            result.flags.append('no_typing_detected')
 
         # Flag 4: Unrealistically fast typing
         t_typing = timing_data.get('t_typing_duration')
         if t_typing is not None and t_typing < 150:
-            details['flags'].append('fast_typing')
+            result.flags.append('fast_typing')
 
-        details['timing_data'] = timing_data
+        result.extras['timing_data'] = timing_data
 
-    except (json.JSONDecodeError, TypeError) as e:
+    except (orjson.JSONDecodeError, TypeError) as e:
         # Invalid metadata is suspicious
-        score += 30
-        details['flags'].append('invalid_metadata')
-        details['error'] = str(e)
+        result.score += 30
+        result.flags.append('invalid_metadata')
+        result.extras['error'] = str(e)
 
-    return score, details
+    return result
 
 
 # ========================================
 # LAYER 2: HEADLESS BROWSER DETECTION
 # ========================================
 
-def analyze_headless_signals(headless_score: int) -> Tuple[int, Dict]:
+def analyze_headless_signals(headless_score: int) -> LayerResult:
     """
     Analyze headless browser detection signals from client.
 
@@ -74,30 +183,26 @@ def analyze_headless_signals(headless_score: int) -> Tuple[int, Dict]:
         headless_score: Client-calculated headless detection score
 
     Returns:
-        Tuple of (score, details_dict)
+        LayerResult for the headless layer
     """
-    details = {
-        'layer': 'headless',
-        'client_score': headless_score,
-        'flags': []
-    }
+    result = LayerResult('headless', headless_score, extras={'client_score': headless_score})
 
     # High headless score is a strong indicator
     if headless_score >= 100:
-        details['flags'].append('webdriver_flag_detected')
+        result.flags.append('webdriver_flag_detected')
     elif headless_score >= 50:
-        details['flags'].append('multiple_headless_indicators')
+        result.flags.append('multiple_headless_indicators')
     elif headless_score >= 20:
-        details['flags'].append('suspicious_browser_properties')
+        result.flags.append('suspicious_browser_properties')
 
-    return headless_score, details
+    return result
 
 
 # ========================================
 # LAYER 3: FINGERPRINT VALIDATION
 # ========================================
 
-def validate_fingerprint(fingerprint: str, session) -> Tuple[int, Dict]:
+def validate_fingerprint(fingerprint: str, session) -> LayerResult:
     """
     Validate browser fingerprint against session history.
 
@@ -106,151 +211,150 @@ def validate_fingerprint(fingerprint: str, session) -> Tuple[int, Dict]:
         session: Flask session object
 
     Returns:
-        Tuple of (score, details_dict)
+        LayerResult for the fingerprint layer
     """
-    score = 0
-    details = {
-        'layer': 'fingerprint',
-        'flags': [],
-        'fingerprint': fingerprint
-    }
+    result = LayerResult('fingerprint', extras={'fingerprint': fingerprint})
 
     # Check if fingerprint exists
-    if not fingerprint or len(fingerprint) < 5:
-        score += 40
-        details['flags'].append('missing_or_invalid_fingerprint')
-        return score, details
+    if not fingerprint or not 5 <= len(fingerprint) <= MAX_FINGERPRINT_LENGTH:
+        result.score += 40
+        result.flags.append('missing_or_invalid_fingerprint')
+        return result
+
+    # Only a short prefix is kept in the session, as an integer so it is
+    # compared in one operation (sentinel.js emits base-36 hashes)
+    if not FINGERPRINT_RE.fullmatch(fingerprint):
+        # Checked up front because int() also accepts signs, '_' separators and whitespace
+        result.score += 40
+        result.flags.append('missing_or_invalid_fingerprint')
+        return result
+
+    fp64 = int(fingerprint[:16], 36)
 
     # Get stored fingerprint from session
-    stored_fingerprint = session.get('browser_fingerprint')
+    stored_fingerprint = session.get('fp64')
 
     if stored_fingerprint is None:
         # First time seeing this session - store the fingerprint
-        session['browser_fingerprint'] = fingerprint
-        details['status'] = 'fingerprint_stored'
-    elif stored_fingerprint != fingerprint:
+        session['fp64'] = fp64
+        result.extras['status'] = 'fingerprint_stored'
+    elif stored_fingerprint != fp64:
         # Fingerprint changed within same session - suspicious
-        score += 50
-        details['flags'].append('fingerprint_mismatch')
-        details['stored_fingerprint'] = stored_fingerprint
+        result.score += 50
+        result.flags.append('fingerprint_mismatch')
+        result.extras['stored_fingerprint'] = stored_fingerprint
     else:
         # Fingerprint matches - good sign
-        details['status'] = 'fingerprint_valid'
+        result.extras['status'] = 'fingerprint_valid'
 
-    return score, details
+    return result
 
 
 # ========================================
 # LAYER 4: VELOCITY & RATE LIMITING
 # ========================================
 
-def check_rate_limit(username: str, ip_address: str, db) -> Tuple[bool, Dict]:
+def check_rate_limit(username: str, ip_address: str, db) -> Tuple[bool, LayerResult]:
     """
     Check if username/IP combination has exceeded rate limits.
 
+    Uses a Redis sorted set as a sliding window: each attempt is a member
+    scored by its timestamp, so pruning, recording and counting happen in
+    one pipelined round-trip with no disk I/O.
+
     Args:
         username: Attempted username
         ip_address: Client IP address
         db: Database connection
 
     Returns:
-        Tuple of (is_blocked, details_dict)
+        Tuple of (is_blocked, LayerResult for the rate limiting layer)
     """
-    from app.database import get_login_attempts, record_login_attempt
+    from app.database import get_redis, get_login_attempt_count
 
-    max_attempts = current_app.config['MAX_LOGIN_ATTEMPTS']
-    window_seconds = current_app.config['RATE_LIMIT_WINDOW']
+    max_attempts = MAX_LOGIN_ATTEMPTS
+    window_seconds = RATE_LIMIT_WINDOW
 
-    # Get recent attempts
-    attempts = get_login_attempts(db, username, ip_address, window_seconds)
+    key = f"rl:login:{username}:{ip_address}"
+    now = time.time()
 
-    details = {
-        'layer': 'rate_limiting',
-        'attempts_count': len(attempts),
+    try:
+        # Prune expired entries, record this attempt and count in one round-trip
+        pipe = get_redis().pipeline()
+        pipe.zremrangebyscore(key, 0, now - window_seconds)
+        pipe.zadd(key, {str(uuid4()): now})
+        pipe.zcard(key)
+        pipe.expire(key, window_seconds)
+        _, _, attempts_count, _ = pipe.execute()
+
+        # The count includes the attempt just recorded
+        attempts_count -= 1
+    except redis.RedisError as e:
+        # Redis unavailable - fall back to the SQLite audit log
+        current_app.logger.warning('Rate limit falling back to SQLite: %s', e)
+        attempts_count = get_login_attempt_count(db, username, ip_address, window_seconds)
+
+    result = LayerResult('rate_limiting', extras={
+        'attempts_count': attempts_count,
         'max_attempts': max_attempts,
-        'window_seconds': window_seconds,
-        'flags': []
-    }
+        'window_seconds': window_seconds
+    })
 
-    is_blocked = len(attempts) >= max_attempts
+    is_blocked = attempts_count >= max_attempts
 
     if is_blocked:
-        details['flags'].append('rate_limit_exceeded')
-        details['status'] = 'blocked'
+        result.flags.append('rate_limit_exceeded')
+        result.extras['status'] = 'blocked'
     else:
-        details['status'] = 'within_limits'
+        result.extras['status'] = 'within_limits'
 
-    # Record this attempt
-    record_login_attempt(db, username, ip_address)
-
-    return is_blocked, details
+    return is_blocked, result
 
 
 # ========================================
 # LAYER 5: IP REPUTATION CHECK
 # ========================================
 
-def check_ip_reputation(ip_address: str) -> Tuple[int, Dict]:
+def check_ip_reputation(ip_address: str) -> LayerResult:
     """
     Check IP address against reputation service.
 
+    Results come from an in-memory cache. On a miss the IP is queued for a
+    background batch lookup and a neutral score is returned meanwhile, so a
+    login never waits on the remote API.
+
     Args:
         ip_address: Client IP address
 
     Returns:
-        Tuple of (score, details_dict)
+        LayerResult for the IP reputation layer
     """
-    score = 0
-    details = {
-        'layer': 'ip_reputation',
-        'ip_address': ip_address,
-        'flags': []
-    }
-
-    api_key = current_app.config.get('IP_REPUTATION_API_KEY')
+    result = LayerResult('ip_reputation', extras={'ip_address': ip_address})
 
-    if not api_key:
+    if not IP_REPUTATION_API_KEY:
         # No API key configured - skip check
-        details['status'] = 'api_key_not_configured'
-        return score, details
+        result.extras['status'] = 'api_key_not_configured'
+        return result
 
-    # Placeholder for IP reputation API integration
-    # In production, integrate with services like:
-    # - IPQualityScore (https://www.ipqualityscore.com/)
-    # - AbuseIPDB (https://www.abuseipdb.com/)
-    # - MaxMind minFraud
+    cached = ip_reputation_cache.get(ip_address)
+    if cached is None:
+        ip_reputation_cache.request_lookup(ip_address)
+        result.extras['status'] = 'pending'
+        return result
 
-    try:
-        # Example API call (uncomment and configure for production)
-        # response = requests.get(
-        #     f'https://api.ipqualityscore.com/v1/ip/{api_key}/{ip_address}',
-        #     timeout=2
-        # )
-        # data = response.json()
-        #
-        # if data.get('fraud_score', 0) > 75:
-        #     score += 80
-        #     details['flags'].append('high_fraud_score')
-        # elif data.get('proxy') or data.get('vpn'):
-        #     score += 30
-        #     details['flags'].append('proxy_or_vpn_detected')
-
-        # Placeholder response for development
-        details['status'] = 'placeholder_mode'
-        details['note'] = 'Configure IP_REPUTATION_API_KEY in .env for production use'
-
-    except requests.RequestException as e:
-        details['status'] = 'api_error'
-        details['error'] = str(e)
-
-    return score, details
+    result.score, flags = cached
+    result.flags.extend(flags)
+    result.extras['status'] = 'cached'
+
+    return result
 
 
 # ========================================
 # MASTER SCORING FUNCTION
 # ========================================
 
-def calculate_bot_score(form_data: Dict, session, db) -> Dict:
+def calculate_bot_score(form_data: Mapping[str, str], session, db, ip_address: str,
+                        username: str) -> Dict:
     """
     Master function to calculate composite bot score from all layers.
 
@@ -258,68 +362,47 @@ def calculate_bot_score(form_data: Dict, session, db) -> Dict:
         form_data: Form data from login request
         session: Flask session object
         db: Database connection
+        ip_address: Client IP address
+        username: Attempted username
 
     Returns:
         Dictionary with bot score and detailed analysis
     """
-    total_score = 0
-    analysis = {
-        'layers': {},
-        'total_score': 0,
-        'verdict': 'unknown',
-        'blocked': False
-    }
-
-    # Get client IP
-    ip_address = request.headers.get('X-Forwarded-For', request.remote_addr) or '127.0.0.1'
-    if ',' in ip_address:
-        ip_address = ip_address.split(',')[0].strip()
-
     # Extract sentinel data
     timing_score = int(form_data.get('sentinel_timing', 0))
     headless_score = int(form_data.get('sentinel_headless', 0))
     fingerprint = form_data.get('sentinel_fingerprint', '')
     metadata = form_data.get('sentinel_metadata', '{}')
-    username = form_data.get('username', '')
 
-    # Layer 1: Behavioral Timing
-    score, details = analyze_timing_behavior(timing_score, metadata)
-    total_score += score
-    analysis['layers']['timing'] = details
+    # Layers 1-3: Behavioral Timing, Headless Detection, Fingerprint Validation
+    layers = [
+        analyze_timing_behavior(timing_score, metadata),
+        analyze_headless_signals(headless_score),
+        validate_fingerprint(fingerprint, session)
+    ]
 
-    # Layer 2: Headless Detection
-    score, details = analyze_headless_signals(headless_score)
-    total_score += score
-    analysis['layers']['headless'] = details
+    # Layer 4: Rate Limiting
+    is_rate_limited, rate_limit = check_rate_limit(username, ip_address, db)
+    layers.append(rate_limit)
 
-    # Layer 3: Fingerprint Validation
-    score, details = validate_fingerprint(fingerprint, session)
-    total_score += score
-    analysis['layers']['fingerprint'] = details
+    # Layer 5: IP Reputation
+    layers.append(check_ip_reputation(ip_address))
 
-    # Layer 4: Rate Limiting
-    is_rate_limited, details = check_rate_limit(username, ip_address, db)
+    total_score = sum(layer.score for layer in layers)
     if is_rate_limited:
         total_score += 100  # Automatic block
-    analysis['layers']['rate_limiting'] = details
-
-    # Layer 5: IP Reputation
-    score, details = check_ip_reputation(ip_address)
-    total_score += score
-    analysis['layers']['ip_reputation'] = details
 
     # Final verdict
-    analysis['total_score'] = total_score
-    threshold = current_app.config['BOT_SCORE_THRESHOLD']
-
     if is_rate_limited:
-        analysis['verdict'] = 'blocked_rate_limit'
-        analysis['blocked'] = True
-    elif total_score >= threshold:
-        analysis['verdict'] = 'blocked_bot_detected'
-        analysis['blocked'] = True
+        verdict = 'blocked_rate_limit'
+    elif total_score >= BOT_SCORE_THRESHOLD:
+        verdict = 'blocked_bot_detected'
     else:
-        analysis['verdict'] = 'passed'
-        analysis['blocked'] = False
+        verdict = 'passed'
 
-    return analysis
+    return {
+        'layers': {layer.layer: layer.to_dict() for layer in layers},
+        'total_score': total_score,
+        'verdict': verdict,
+        'blocked': verdict != 'passed'
+    }
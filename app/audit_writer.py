@@ -0,0 +1,99 @@
+# app/audit_writer.py
+"""
+Audit writer for SentinelAuth
+Records login attempts and fingerprint usage on a background thread so requests
+never wait on a SQLite commit.
+"""
+
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Tuple
+
+from app.database import (DATABASE_PATH, INSERT_LOGIN_ATTEMPT_SQL, UPSERT_FINGERPRINT_SQL,
+                          configure_connection)
+
+
+BATCH_SIZE = 500
+FLUSH_INTERVAL = 0.1  # seconds
+
+logger = logging.getLogger(__name__)
+
+_queue: "queue.Queue[Tuple[str, Tuple]]" = queue.Queue()
+_thread = None
+_thread_lock = threading.Lock()
+
+
+def enqueue(row: Tuple) -> None:
+    """
+    Queue a login attempt for the background writer.
+
+    Args:
+        row: Tuple of (username, ip_address, timestamp, user_agent, bot_score, blocked)
+    """
+    _queue.put((INSERT_LOGIN_ATTEMPT_SQL, row))
+
+
+def enqueue_fingerprint(fingerprint: str, ip_address: str, timestamp: int) -> None:
+    """
+    Queue a fingerprint usage update for the background writer.
+
+    Args:
+        fingerprint: Browser fingerprint hash
+        ip_address: Client IP address
+        timestamp: Time the fingerprint was seen
+    """
+    _queue.put((UPSERT_FINGERPRINT_SQL, (fingerprint, ip_address, timestamp, timestamp)))
+
+
+def start() -> None:
+    """Start the writer thread if it is not already running."""
+    global _thread
+    with _thread_lock:
+        if _thread is not None and _thread.is_alive():
+            return
+        _thread = threading.Thread(target=_drain, name='audit-writer', daemon=True)
+        _thread.start()
+
+
+def _next_batch() -> list:
+    """Block for one item, then collect up to BATCH_SIZE items or until FLUSH_INTERVAL elapses."""
+    batch = [_queue.get()]
+    deadline = time.monotonic() + FLUSH_INTERVAL
+
+    while len(batch) < BATCH_SIZE:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        try:
+            batch.append(_queue.get(timeout=remaining))
+        except queue.Empty:
+            break
+
+    return batch
+
+
+def _drain() -> None:
+    """Writer loop: write each batch with a single commit."""
+    db = sqlite3.connect(DATABASE_PATH, isolation_level=None)
+    configure_connection(db)
+
+    while True:
+        batch = _next_batch()
+
+        # Group rows by statement so each runs as one executemany
+        rows_by_sql: Dict[str, List[Tuple]] = {}
+        for sql, row in batch:
+            rows_by_sql.setdefault(sql, []).append(row)
+
+        try:
+            db.execute('BEGIN')
+            for sql, rows in rows_by_sql.items():
+                db.executemany(sql, rows)
+            db.execute('COMMIT')
+        except sqlite3.Error:
+            if db.in_transaction:
+                db.execute('ROLLBACK')
+            logger.exception('Failed to write %d audit records', len(batch))
@@ -1,18 +1,38 @@
 # app/database.py
 """
 Database module for SentinelAuth
-Handles rate limiting and login attempt tracking using SQLite.
+Handles login attempt tracking using SQLite and the Redis client used for rate limiting.
 """
 
 import sqlite3
+import threading
 import time
 from typing import List, Dict, Optional
 from flask import g, current_app
 import os
+import redis
 
 
 DATABASE_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'sentinel_auth.db')
 
+_cleanup_thread = None
+_cleanup_thread_lock = threading.Lock()
+
+# Audit writes are batched by app.audit_writer rather than issued per request
+INSERT_LOGIN_ATTEMPT_SQL = '''
+    INSERT INTO login_attempts
+    (username, ip_address, timestamp, user_agent, bot_score, blocked)
+    VALUES (?, ?, ?, ?, ?, ?)
+'''
+
+UPSERT_FINGERPRINT_SQL = '''
+    INSERT INTO fingerprint_history
+    (fingerprint, ip_address, first_seen, last_seen, request_count)
+    VALUES (?, ?, ?, ?, 1)
+    ON CONFLICT (fingerprint, ip_address) DO UPDATE
+    SET last_seen = excluded.last_seen, request_count = request_count + 1
+'''
+
 
 def get_db():
     """
@@ -25,9 +45,40 @@ def get_db():
             detect_types=sqlite3.PARSE_DECLTYPES
         )
         g.db.row_factory = sqlite3.Row
+        configure_connection(g.db)
     return g.db
 
 
+def configure_connection(db) -> None:
+    """
+    Apply per-connection performance settings.
+    NORMAL drops the per-commit fsync (safe under WAL); the cache, temp store
+    and mmap settings keep index pages in memory.
+
+    Args:
+        db: Database connection
+    """
+    db.executescript('''
+        PRAGMA synchronous=NORMAL;
+        PRAGMA temp_store=MEMORY;
+        PRAGMA cache_size=-20000;
+        PRAGMA mmap_size=268435456;
+    ''')
+
+
+def get_redis():
+    """
+    Get the shared Redis client for rate limiting.
+    The client is created once and cached on the app's extensions dict;
+    redis-py pools connections internally, so it is safe to share across requests.
+    """
+    client = current_app.extensions.get('redis')
+    if client is None:
+        client = redis.Redis.from_url(current_app.config['REDIS_URL'])
+        current_app.extensions['redis'] = client
+    return client
+
+
 def close_db(e=None):
     """Close database connection at end of request."""
     db = g.pop('db', None)
@@ -35,13 +86,14 @@ def close_db(e=None):
         db.close()
 
 
-def init_db():
-    """Initialize database schema."""
-    # Connect directly instead of using get_db() since we're outside request context
-    db = sqlite3.connect(DATABASE_PATH, detect_types=sqlite3.PARSE_DECLTYPES)
-    db.row_factory = sqlite3.Row
-    cursor = db.cursor()
+def create_schema(cursor) -> None:
+    """
+    Create tables and indexes that do not exist yet.
+    Runs inside the caller's transaction; the caller commits.
 
+    Args:
+        cursor: Cursor on the connection holding the transaction
+    """
     # Create login_attempts table for rate limiting
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS login_attempts (
@@ -56,11 +108,14 @@ def init_db():
     ''')
 
     # Create indexes for login_attempts
+    # Covers the username/IP lookup and its ORDER BY timestamp, superseding idx_username_ip
     cursor.execute('''
-        CREATE INDEX IF NOT EXISTS idx_username_ip
-        ON login_attempts (username, ip_address)
+        CREATE INDEX IF NOT EXISTS idx_attempts_user_ip_ts
+        ON login_attempts (username, ip_address, timestamp DESC)
     ''')
 
+    cursor.execute('DROP INDEX IF EXISTS idx_username_ip')
+
     cursor.execute('''
         CREATE INDEX IF NOT EXISTS idx_timestamp
         ON login_attempts (timestamp)
@@ -79,48 +134,70 @@ def init_db():
     ''')
 
     # Create indexes for fingerprint_history
+    # Unique index (rather than a table constraint) so existing databases pick it up;
+    # it is the conflict target for UPSERT_FINGERPRINT_SQL and supersedes idx_fingerprint
     cursor.execute('''
-        CREATE INDEX IF NOT EXISTS idx_fingerprint
-        ON fingerprint_history (fingerprint)
+        SELECT 1 FROM sqlite_master
+        WHERE type = 'index' AND name = 'idx_fingerprint_ip'
     ''')
+    if cursor.fetchone() is None:
+        # Older databases may hold duplicate pairs from the non-atomic SELECT-then-INSERT;
+        # merge them into the lowest id so the unique index can be built
+        cursor.execute('''
+            UPDATE fingerprint_history AS keep
+            SET first_seen = (SELECT MIN(first_seen) FROM fingerprint_history AS dup
+                              WHERE dup.fingerprint = keep.fingerprint
+                              AND dup.ip_address = keep.ip_address),
+                last_seen = (SELECT MAX(last_seen) FROM fingerprint_history AS dup
+                             WHERE dup.fingerprint = keep.fingerprint
+                             AND dup.ip_address = keep.ip_address),
+                request_count = (SELECT SUM(request_count) FROM fingerprint_history AS dup
+                                 WHERE dup.fingerprint = keep.fingerprint
+                                 AND dup.ip_address = keep.ip_address)
+            WHERE id IN (
+                SELECT MIN(id) FROM fingerprint_history
+                GROUP BY fingerprint, ip_address
+                HAVING COUNT(*) > 1
+            )
+        ''')
+
+        cursor.execute('''
+            DELETE FROM fingerprint_history
+            WHERE id NOT IN (
+                SELECT MIN(id) FROM fingerprint_history
+                GROUP BY fingerprint, ip_address
+            )
+        ''')
 
     cursor.execute('''
-        CREATE INDEX IF NOT EXISTS idx_ip
-        ON fingerprint_history (ip_address)
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_fingerprint_ip
+        ON fingerprint_history (fingerprint, ip_address)
     ''')
 
-    db.commit()
-    db.close()
-
+    cursor.execute('DROP INDEX IF EXISTS idx_fingerprint')
 
-def record_login_attempt(db, username: str, ip_address: str,
-                         user_agent: str = 'Unknown', bot_score: int = 0,
-                         blocked: bool = False) -> int:
-    """
-    Record a login attempt to the database.
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_ip
+        ON fingerprint_history (ip_address)
+    ''')
 
-    Args:
-        db: Database connection
-        username: Attempted username
-        ip_address: Client IP address
-        user_agent: User agent string (optional)
-        bot_score: Calculated bot score
-        blocked: Whether attempt was blocked
 
-    Returns:
-        ID of the inserted record
-    """
+def init_db():
+    """Initialize database schema."""
+    # Connect directly instead of using get_db() since we're outside request context
+    db = sqlite3.connect(DATABASE_PATH, detect_types=sqlite3.PARSE_DECLTYPES)
+    db.row_factory = sqlite3.Row
     cursor = db.cursor()
-    timestamp = int(time.time())
 
-    cursor.execute('''
-        INSERT INTO login_attempts
-        (username, ip_address, timestamp, user_agent, bot_score, blocked)
-        VALUES (?, ?, ?, ?, ?, ?)
-    ''', (username, ip_address, timestamp, user_agent, bot_score, int(blocked)))
+    # WAL lets readers run alongside the writer; the mode is stored in the database file
+    cursor.execute('PRAGMA journal_mode=WAL')
+
+    # Create all tables and indexes in one transaction
+    cursor.execute('BEGIN')
+    create_schema(cursor)
 
     db.commit()
-    return cursor.lastrowid
+    db.close()
 
 
 def get_login_attempts(db, username: str, ip_address: str,
@@ -151,42 +228,31 @@ def get_login_attempts(db, username: str, ip_address: str,
     return [dict(row) for row in cursor.fetchall()]
 
 
-def record_fingerprint(db, fingerprint: str, ip_address: str) -> None:
+def get_login_attempt_count(db, username: str, ip_address: str,
+                            window_seconds: int) -> int:
     """
-    Record or update fingerprint usage.
+    Count recent login attempts for a username/IP combination.
 
     Args:
         db: Database connection
-        fingerprint: Browser fingerprint hash
-        ip_address: Client IP address
+        username: Username to check
+        ip_address: IP address to check
+        window_seconds: Time window in seconds to look back
+
+    Returns:
+        Number of matching login attempts
     """
     cursor = db.cursor()
-    current_time = int(time.time())
+    cutoff_time = int(time.time()) - window_seconds
 
-    # Check if fingerprint already exists
     cursor.execute('''
-        SELECT id, request_count FROM fingerprint_history
-        WHERE fingerprint = ? AND ip_address = ?
-    ''', (fingerprint, ip_address))
-
-    result = cursor.fetchone()
-
-    if result:
-        # Update existing record
-        cursor.execute('''
-            UPDATE fingerprint_history
-            SET last_seen = ?, request_count = request_count + 1
-            WHERE id = ?
-        ''', (current_time, result['id']))
-    else:
-        # Insert new record
-        cursor.execute('''
-            INSERT INTO fingerprint_history
-            (fingerprint, ip_address, first_seen, last_seen, request_count)
-            VALUES (?, ?, ?, ?, 1)
-        ''', (fingerprint, ip_address, current_time, current_time))
+        SELECT COUNT(*) FROM login_attempts
+        WHERE username = ?
+        AND ip_address = ?
+        AND timestamp >= ?
+    ''', (username, ip_address, cutoff_time))
 
-    db.commit()
+    return cursor.fetchone()[0]
 
 
 def get_fingerprint_history(db, fingerprint: str) -> Optional[Dict]:
@@ -238,6 +304,37 @@ def cleanup_old_records(db, days: int = 7) -> int:
     return deleted_attempts + deleted_fingerprints
 
 
+def start_cleanup(app) -> None:
+    """
+    Start the periodic cleanup thread if it is not already running.
+
+    Args:
+        app: Flask app providing CLEANUP_INTERVAL, RECORD_RETENTION_DAYS and the logger
+    """
+    global _cleanup_thread
+    with _cleanup_thread_lock:
+        if _cleanup_thread is not None and _cleanup_thread.is_alive():
+            return
+        _cleanup_thread = threading.Thread(target=_cleanup_loop, args=(app,),
+                                           name='record-cleanup', daemon=True)
+        _cleanup_thread.start()
+
+
+def _cleanup_loop(app) -> None:
+    """Cleanup loop: delete old records every CLEANUP_INTERVAL seconds."""
+    while True:
+        time.sleep(app.config['CLEANUP_INTERVAL'])
+        try:
+            db = sqlite3.connect(DATABASE_PATH)
+            try:
+                deleted = cleanup_old_records(db, days=app.config['RECORD_RETENTION_DAYS'])
+            finally:
+                db.close()
+            app.logger.info('Cleanup removed %d old records', deleted)
+        except sqlite3.Error:
+            app.logger.exception('Cleanup of old records failed')
+
+
 def get_statistics(db) -> Dict:
     """
     Get statistics about login attempts and blocks.
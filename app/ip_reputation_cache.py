@@ -0,0 +1,191 @@
+# app/ip_reputation_cache.py
+"""
+IP reputation cache for SentinelAuth
+Keeps reputation results in memory and fills cache misses from a background
+thread that looks up queued IPs in batches, so logins never wait on the remote API.
+"""
+
+import logging
+import threading
+import time
+from collections import deque
+from typing import Deque, Dict, Iterable, List, Optional, Set, Tuple
+
+import requests
+from cachetools import TTLCache
+from requests.adapters import HTTPAdapter
+
+
+CACHE_MAXSIZE = 10_000
+CACHE_TTL = 3600  # 1 hour in seconds
+
+# IPs a lookup failed for get a neutral result for this long, and the
+# refresher pauses after a failed batch, so a broken endpoint is not hammered
+FAILURE_TTL = 60  # seconds
+FAILURE_BACKOFF = 5  # seconds
+
+BATCH_SIZE = 100
+FLUSH_INTERVAL = 0.05  # seconds
+RETRIES = 1
+RETRY_BACKOFF = 0.1  # seconds
+
+# IPQualityScore batch lookup; other services (AbuseIPDB, MaxMind minFraud)
+# need their own URL and a matching _score_reputation
+BATCH_URL = 'https://api.ipqualityscore.com/v1/ip-batch/{api_key}'
+
+logger = logging.getLogger(__name__)
+
+_cache: TTLCache = TTLCache(maxsize=CACHE_MAXSIZE, ttl=CACHE_TTL)
+_failures: TTLCache = TTLCache(maxsize=CACHE_MAXSIZE, ttl=FAILURE_TTL)
+_lock = threading.Lock()
+
+_queue: Deque[str] = deque()
+_pending: Set[str] = set()
+_wakeup = threading.Event()
+_thread = None
+
+# Shared HTTP session so batch lookups reuse pooled connections.
+# Retries are done in _refresh rather than by urllib3, whose retry warning
+# logs the request URL - and BATCH_URL carries the API key.
+_SESSION = requests.Session()
+_SESSION.mount('https://', HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=50,
+    max_retries=0
+))
+
+
+def get(ip_address: str) -> Optional[Tuple[int, Tuple[str, ...]]]:
+    """
+    Look up a cached reputation result.
+
+    Args:
+        ip_address: Client IP address
+
+    Returns:
+        Tuple of (score, flags), neutral if the last lookup failed, or None if not cached
+    """
+    with _lock:
+        result = _cache.get(ip_address)
+        if result is None:
+            result = _failures.get(ip_address)
+        return result
+
+
+def put(ip_address: str, score: int, flags: Tuple[str, ...]) -> None:
+    """
+    Store a reputation result.
+
+    Args:
+        ip_address: Client IP address
+        score: Reputation score contribution
+        flags: Reputation flags
+    """
+    with _lock:
+        _cache[ip_address] = (score, tuple(flags))
+
+
+def request_lookup(ip_address: str) -> None:
+    """
+    Queue an IP for the next batch lookup. IPs already queued are ignored.
+
+    Args:
+        ip_address: Client IP address
+    """
+    with _lock:
+        if ip_address in _pending:
+            return
+        _pending.add(ip_address)
+    _queue.append(ip_address)
+    _wakeup.set()
+
+
+def start(api_key: str) -> None:
+    """
+    Start the batch lookup thread if it is not already running.
+
+    Args:
+        api_key: IP reputation service API key
+    """
+    global _thread
+    with _lock:
+        if _thread is not None and _thread.is_alive():
+            return
+        _thread = threading.Thread(target=_refresh_loop, args=(api_key,),
+                                   name='ip-reputation-refresher', daemon=True)
+        _thread.start()
+
+
+def _score_reputation(data: Dict) -> Tuple[int, Tuple[str, ...]]:
+    """
+    Convert an IP reputation API result into a score and flags.
+
+    Args:
+        data: Parsed result for a single IP
+
+    Returns:
+        Tuple of (score, flags)
+    """
+    if data.get('fraud_score', 0) > 75:
+        return 80, ('high_fraud_score',)
+    if data.get('proxy') or data.get('vpn'):
+        return 30, ('proxy_or_vpn_detected',)
+    return 0, ()
+
+
+def _refresh_loop(api_key: str) -> None:
+    """Refresher loop: wait for queued IPs, let concurrent misses coalesce, then look them up."""
+    while True:
+        _wakeup.wait()
+        time.sleep(FLUSH_INTERVAL)
+        _wakeup.clear()
+
+        while _queue:
+            batch: List[str] = []
+            while _queue and len(batch) < BATCH_SIZE:
+                batch.append(_queue.popleft())
+            if not _refresh(api_key, batch):
+                time.sleep(FAILURE_BACKOFF)
+
+
+def _refresh(api_key: str, ip_addresses: Iterable[str]) -> bool:
+    """Look up a batch of IPs in one request and cache the results. Returns False on failure."""
+    ip_addresses = list(ip_addresses)
+    resolved: Set[str] = set()
+
+    try:
+        for attempt in range(RETRIES + 1):
+            try:
+                response = _SESSION.get(
+                    BATCH_URL.format(api_key=api_key),
+                    params={'ips': ','.join(ip_addresses)},
+                    timeout=2
+                )
+                response.raise_for_status()
+                break
+            except requests.RequestException:
+                if attempt == RETRIES:
+                    raise
+                time.sleep(RETRY_BACKOFF)
+
+        for data in response.json():
+            if data.get('ip') in ip_addresses:
+                score, flags = _score_reputation(data)
+                put(data['ip'], score, flags)
+                resolved.add(data['ip'])
+
+    except (requests.RequestException, AttributeError, TypeError) as e:
+        # Exception messages from requests include the URL, which contains the API key
+        logger.warning('IP reputation lookup failed for %d IPs: %s',
+                       len(ip_addresses), type(e).__name__)
+
+    finally:
+        # IPs missing from the response (or a failed batch) get a neutral result
+        # until FAILURE_TTL expires, then are looked up again on their next login
+        with _lock:
+            for ip_address in ip_addresses:
+                if ip_address not in resolved:
+                    _failures[ip_address] = (0, ())
+            _pending.difference_update(ip_addresses)
+
+    return len(resolved) == len(ip_addresses)
@@ -4,10 +4,11 @@ Flask routes for SentinelAuth
 Handles login page display and authentication with anti-bot protection.
 """
 
-from flask import Blueprint, request, render_template, jsonify, session
-from app.anti_bot_logic import calculate_bot_score
-from app.database import get_db, record_login_attempt, record_fingerprint
-import json
+from flask import Blueprint, request, render_template, jsonify, session, make_response, abort, current_app
+from app.anti_bot_logic import calculate_bot_score, precheck
+from app import audit_writer
+from app.database import get_db, get_redis, create_schema
+import time
 
 bp = Blueprint('main', __name__)
 
@@ -39,42 +40,46 @@ def login():
         - sentinel_fingerprint: Browser fingerprint hash
         - sentinel_metadata: JSON timing metadata
     """
-    # Get database connection
-    db = get_db()
-
     # Extract form data
-    form_data = request.form.to_dict()
+    form_data = request.form
     username = form_data.get('username', '')
     password = form_data.get('password', '')
 
-    # Extract client IP address (handle X-Forwarded-For with multiple IPs)
-    client_ip = request.headers.get('X-Forwarded-For', request.remote_addr) or '127.0.0.1'
-    if ',' in client_ip:
-        client_ip = client_ip.split(',')[0].strip()
+    # Extract client IP address (ProxyFix resolves X-Forwarded-For)
+    client_ip = request.remote_addr or '127.0.0.1'
 
     # Extract user agent with fallback
     user_agent = request.headers.get('User-Agent') or 'Unknown'
 
+    # Reject abusive IPs/usernames before running the full analysis
+    is_blocked, retry_after = precheck(client_ip, username)
+    if is_blocked:
+        response = make_response(render_template('index.html',
+                                                 error='Too many login attempts. Please try again later.'), 429)
+        response.headers['Retry-After'] = str(retry_after)
+        return response
+
+    # Get database connection (only for requests that pass the pre-check)
+    db = get_db()
+
     # Calculate bot score using all defensive layers
-    analysis = calculate_bot_score(form_data, session, db)
+    analysis = calculate_bot_score(form_data, session, db, client_ip, username)
 
-    # Record fingerprint if present
+    # Record fingerprint if valid, skipping pairs this session already recorded
+    # (invalid ones, e.g. oversized, never reach the session cookie or the database)
     fingerprint = form_data.get('sentinel_fingerprint', '')
-    if fingerprint:
-        record_fingerprint(db, fingerprint, client_ip)
+    if 'missing_or_invalid_fingerprint' not in analysis['layers']['fingerprint']['flags']:
+        # Same 16-character prefix as the fp64 session value keeps the cookie small
+        fingerprint_key = f"{fingerprint[:16]}|{client_ip}"
+        if session.get('fs') != fingerprint_key:
+            session['fs'] = fingerprint_key
+            audit_writer.enqueue_fingerprint(fingerprint, client_ip, int(time.time()))
 
     # Check if request is blocked
     if analysis['blocked']:
         # Record blocked attempt
-
-        record_login_attempt(
-            db,
-            username=username,
-            ip_address=client_ip,
-            user_agent=user_agent,
-            bot_score=analysis['total_score'],
-            blocked=True
-        )
+        audit_writer.enqueue((username, client_ip, int(time.time()), user_agent,
+                              analysis['total_score'], 1))
 
         # Return error response
         return render_template('index.html',
@@ -97,28 +102,16 @@ def login():
         session['username'] = username
 
         # Record successful attempt
-        record_login_attempt(
-            db,
-            username=username,
-            ip_address=client_ip,
-            user_agent=user_agent,
-            bot_score=analysis['total_score'],
-            blocked=False
-        )
+        audit_writer.enqueue((username, client_ip, int(time.time()), user_agent,
+                              analysis['total_score'], 0))
 
         return render_template('success.html',
                              username=username,
                              analysis=analysis)
     else:
         # Invalid credentials
-        record_login_attempt(
-            db,
-            username=username,
-            ip_address=client_ip,
-            user_agent=user_agent,
-            bot_score=analysis['total_score'],
-            blocked=False
-        )
+        audit_writer.enqueue((username, client_ip, int(time.time()), user_agent,
+                              analysis['total_score'], 0))
 
         return render_template('index.html',
                              error='Invalid username or password.',
@@ -150,9 +143,10 @@ def debug_analysis():
     WARNING: Remove this endpoint in production!
     """
     db = get_db()
-    form_data = request.form.to_dict()
+    form_data = request.form
 
-    analysis = calculate_bot_score(form_data, session, db)
+    analysis = calculate_bot_score(form_data, session, db, request.remote_addr or '127.0.0.1',
+                                   form_data.get('username', ''))
 
     return jsonify(analysis)
 
@@ -160,21 +154,30 @@ def debug_analysis():
 @bp.route('/reset-db', methods=['POST'])
 def reset_database():
     """
-    Reset the database by clearing all login attempts and fingerprints.
+    Reset the database by clearing all login attempts, fingerprints and rate limits.
+    Only available in debug mode (FLASK_DEBUG=1).
     WARNING: This is for demo purposes only! Remove in production!
     """
+    if not current_app.debug:
+        abort(404)
+
     try:
         db = get_db()
         cursor = db.cursor()
 
-        # Clear all login attempts
-        cursor.execute('DELETE FROM login_attempts')
-
-        # Clear all fingerprints
-        cursor.execute('DELETE FROM fingerprint_history')
-
+        # Drop and recreate the tables - constant time, unlike deleting every row.
+        # Both happen in one transaction so other connections never see them missing.
+        cursor.execute('BEGIN')
+        cursor.execute('DROP TABLE IF EXISTS login_attempts')
+        cursor.execute('DROP TABLE IF EXISTS fingerprint_history')
+        create_schema(cursor)
         db.commit()
 
+        # Clear rate limiting counters
+        redis_client = get_redis()
+        for key in redis_client.scan_iter('rl:*'):
+            redis_client.delete(key)
+
         # Clear the session as well
         session.clear()
 
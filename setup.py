@@ -0,0 +1,27 @@
+"""
+Packaging for SentinelAuth, with an optional native build.
+Set SENTINEL_MYPYC=1 to compile the anti-bot scoring engine with mypyc; the
+pure-Python module is used whenever the compiled extension is not present.
+
+    pip install mypy
+    SENTINEL_MYPYC=1 python setup.py build_ext --inplace
+"""
+
+import os
+
+from setuptools import setup
+
+ext_modules = []
+if os.environ.get('SENTINEL_MYPYC') == '1':
+    from mypyc.build import mypycify
+
+    # ip_reputation_cache (networking and threads) stays interpreted
+    ext_modules = mypycify(['app/anti_bot_logic.py'])
+
+setup(
+    name='login-defender',
+    # dataclass(slots=True) in anti_bot_logic needs 3.10
+    python_requires='>=3.10',
+    packages=['app'],
+    ext_modules=ext_modules,
+)